@@ -4,7 +4,7 @@
 
 This code accepts experimental parameters as commandline arguments:
     - RTT
-    - Loss Rates to try as [min, max, interval]
+    - Loss Rates to try
     - Link Bandwidth
     - Length of the trace
 where the default values are the values used in the BBR paper. Then, we
@@ -14,8 +14,12 @@ create the corresponding figures.
 
 import argparse
 from bbr_logging import debug_print, debug_print_verbose, debug_print_error, stdout_print
-from multiprocessing import Process, Queue, Event
+import mmap
+import multiprocessing
+from multiprocessing import Pool, Pipe, Event
+import numpy as np
 import os
+import re
 from server import Server
 import subprocess
 import sys
@@ -24,6 +28,21 @@ import time
 
 EXIT_SUCCESS = 0
 
+SUPPORTED_CONGESTION_CONTROLS = frozenset(
+    ['bbr', 'cubic', 'bic', 'vegas', 'westwood', 'reno', 'bbr557', 'gargbage'])
+
+# Event lines in a mahimahi log are of the format:
+#   timestamp event_type num_bytes [delay]
+_MM_EVENT_TIMESTAMP_RE = re.compile(br'^\d+(?= )', re.M)
+_MM_OPPORTUNITY_RE = re.compile(br'^\d+ # (\d+)', re.M)
+_MM_DEPARTURE_RE = re.compile(br'^\d+ - \d+ \d+', re.M)
+
+# Parsed flags keyed on the commandline arguments they were parsed from.
+_PARSED_ARGS_CACHE = {}
+
+# Trace file contents keyed on (seconds, throughput).
+_TRACE_CACHE = {}
+
 
 class Flags(object):
     """Dictionary object to store parsed flags."""
@@ -43,7 +62,7 @@ class Flags(object):
 
 
 def _check_cc(input):
-    if input.lower() in ['bbr', 'cubic', 'bic', 'vegas', 'westwood', 'reno', 'bbr557', 'gargbage']:
+    if input.lower() in SUPPORTED_CONGESTION_CONTROLS:
         return input.lower()
     else:
         raise argparse.ArgumentTypeError(
@@ -55,43 +74,73 @@ def _clean_up_trace(throughput):
         os.remove(filename)
 
 
-def _generate_trace(seconds, throughput):
-    """Generate a <throughput>Mbps trace that lasts for the specified seconds."""
+def _make_trace(seconds, throughput):
+    """Return the contents of a <throughput>Mbps trace lasting the specified seconds."""
     debug_print("Creating " + str(seconds) +
                 " sec trace @: " + str(throughput) + "Mbps")
     bits_per_packet = 12000
-    low_avg = int((throughput) / (bits_per_packet / 1000))
-    high_avg = low_avg + 1
-    low_err = throughput - (low_avg * 12)
-    high_err = throughput - (high_avg * 12)
+    # Work in whole bits per millisecond (i.e. a 1 kbps resolution) to keep
+    # the schedule in integer arithmetic.
+    bits_per_ms = int(round(throughput * 1000))
+    # Each millisecond delivers either floor(rate) or floor(rate) + 1 packets,
+    # picked so that the accumulated error stays under one packet. That makes
+    # the number of packets delivered by the end of millisecond ms exactly
+    # floor(ms * rate), so the whole schedule can be computed at once.
+    ms = np.arange(int(seconds * 1000) + 1, dtype=np.int64)
+    packets_delivered = ms * bits_per_ms // bits_per_packet
+    num_packets = np.diff(packets_delivered)
+
+    # The uplink and downlink traces are identical, so only format it once,
+    # and write it out in one go rather than line by line. There is one line
+    # per packet holding the millisecond it is delivered in, so each
+    # millisecond's line only needs formatting once.
+    return b''.join([(b'%d\n' % timestamp) * count for timestamp, count in
+                     zip(ms[1:].tolist(), num_packets.tolist())])
+
+
+def _generate_trace(seconds, throughput):
+    """Generate a <throughput>Mbps trace that lasts for the specified seconds.
+
+    Generated traces are cached, so asking for the same trace again only
+    writes out whichever of its files are missing.
+    """
+    key = (seconds, throughput)
+    if key not in _TRACE_CACHE:
+        _TRACE_CACHE[key] = _make_trace(seconds, throughput)
+    trace = _TRACE_CACHE[key]
 
     for filename in [str(throughput) + str(x) for x in ["Mbps.up", "Mbps.down"]]:
-        with open(filename, 'w') as outfile:
-            accumulated_err = 0
-            num_packets = 0
+        if os.path.exists(filename) and os.path.getsize(filename) == len(trace):
+            debug_print_verbose("Reusing existing trace file: " + filename)
+            continue
+        with open(filename, 'wb') as outfile:
+            outfile.write(trace)
 
-            for ms_counter in range(int(seconds * 1000)):
-                if accumulated_err >= abs(high_err):
-                    num_packets = high_avg
-                    accumulated_err += high_err
-                else:
-                    num_packets = low_avg
-                    accumulated_err += low_err
 
-                for j in range(num_packets):
-                    outfile.write(str(ms_counter + 1) + '\n')
+def _int_array(matches):
+    """Parse the numbers in the strings matched by re.findall into an array."""
+    return np.fromstring(b' '.join(matches), dtype=np.int64, sep=' ')
 
 
 def _parse_args():
-    """Parse experimental parameters from the commandline."""
+    """Parse experimental parameters from the commandline.
+
+    The commandline is only parsed the first time it is seen, later calls
+    with the same arguments reuse that result.
+    """
+    argv = tuple(sys.argv[1:])
+    if argv in _PARSED_ARGS_CACHE:
+        Flags.parsed_args = dict(_PARSED_ARGS_CACHE[argv])
+        return
+
     parser = argparse.ArgumentParser(
         description="Process experimental params.")
     parser.add_argument('--time', dest=Flags.TIME, type=int,
                         help="Enter a time in seconds to run each trace.",
                         default=60)
-    parser.add_argument('--loss', dest=Flags.LOSS, type=float,
-                        help="Loss rate to test (%%).",
-                        default=0.1)
+    parser.add_argument('--loss', dest=Flags.LOSS, type=float, nargs='+',
+                        help="Loss rates to test (%%). All of them are run in the same sweep.",
+                        default=[0.1])
     parser.add_argument('--port', dest=Flags.PORT, type=int,
                         help="Which port to use.",
                         default=5050)
@@ -120,51 +169,102 @@ def _parse_args():
                         help="Specify whether the Mahimahi Throughput / Queueing delay graphs come up. On Clouds VMs, you'd want to set this to true.",
                         default=False)
 
-    Flags.parsed_args = vars(parser.parse_args())
-    # Preprocess the loss into a percentage
-    Flags.parsed_args[Flags.LOSS] = Flags.parsed_args[Flags.LOSS] / 100.0
+    Flags.parsed_args = vars(parser.parse_args(argv))
+    # Preprocess the losses into percentages
+    Flags.parsed_args[Flags.LOSS] = [
+        loss / 100.0 for loss in Flags.parsed_args[Flags.LOSS]]
     debug_print_verbose("Parse: " + str(Flags.parsed_args))
+    _PARSED_ARGS_CACHE[argv] = dict(Flags.parsed_args)
+
 
+def _parse_mahimahi_log():
+    """Compute the uplink statistics that mm-throughput-graph reports.
 
-def _parse_mahimahi_log(cc):
-    # Piped to /dev/null because stdout is just the SVG generated.
-    # We just want the throutput information, which is stderr.
+    Returns the average capacity and throughput of the link in Mbps, and the
+    95th percentile per-packet queueing delay and signal delay in ms.
+    """
     debug_print_verbose("Parsing Mahimahi logs...")
-    command_text = "mm-throughput-graph 10 /tmp/mahimahi_log > ~/557/mahimahi/temp/%s_output.svg" % cc
-    command = (command_text)
-    output = subprocess.check_output(
-        command, shell=True, stderr=subprocess.STDOUT)
-    output = output.split('\n')
-    debug_print_verbose(output)
-    capacity = float(output[0].split(' ')[2])
-    goodput = float(output[1].split(' ')[2])
-    q_delay = float(output[2].split(' ')[5])
-    s_delay = float(output[3].split(' ')[4])
-    return (capacity, goodput, q_delay, s_delay)
+    # Scan the log straight out of the page cache rather than reading a copy
+    # of it into memory first.
+    with open("/tmp/mahimahi_log", 'rb') as log:
+        data = mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        timestamps = _int_array(_MM_EVENT_TIMESTAMP_RE.findall(data))
+        opportunities = _int_array(_MM_OPPORTUNITY_RE.findall(data))
+        departures = _MM_DEPARTURE_RE.findall(data)
+    finally:
+        data.close()
+
+    # Timestamps are only ever compared with each other, so there is no need
+    # to correct them for the log's base timestamp.
+    duration_secs = (timestamps.max() - timestamps[0]) / 1000.0
+    capacity_bits = opportunities.sum() * 8
+    capacity = capacity_bits / duration_secs / 1e6
+
+    # Drop the event type so that only the numbers are left to parse.
+    departures = np.fromstring(b' '.join(departures).replace(b' - ', b' '),
+                               dtype=np.int64, sep=' ').reshape(-1, 3)
+    departure_bits = departures[:, 1].sum() * 8
+    goodput = departure_bits / duration_secs / 1e6
+
+    delays = departures[:, 2]
+    q_delay = np.sort(delays)[int(0.95 * len(delays))]
+
+    # The signal delay at a given time is the lowest delay of any packet that
+    # entered the queue then. A message created when no packet entered the
+    # queue has to wait for the next packet that does.
+    arrivals = departures[:, 0] - delays
+    first_arrival = arrivals.min()
+    no_packet = np.iinfo(np.int64).max
+    signal_delays = np.full(arrivals.max() - first_arrival + 1, no_packet, dtype=np.int64)
+    np.minimum.at(signal_delays, arrivals - first_arrival, delays)
+    times = np.arange(len(signal_delays))
+    next_packet = np.minimum.accumulate(
+        np.where(signal_delays != no_packet, times, len(times))[::-1])[::-1]
+    signal_delays = signal_delays[next_packet] + (next_packet - times)
+    s_delay = np.sort(signal_delays)[int(0.95 * len(signal_delays))]
+
+    debug_print_verbose("Capacity: %.2f Mbps, Goodput: %.2f Mbps, Queueing delay: %d ms, Signal delay: %d ms" %
+                        (capacity, goodput, q_delay, s_delay))
+    return (float(capacity), float(goodput), float(q_delay), float(s_delay))
 
 
 def _is_server_listening(port):
     """Determine whether a server at the given port is listening."""
-    command = ["netstat", "-tln", "|", "grep", ":" + str(port)]
-    result = subprocess.check_output(command)
-    result = result.strip()
-    if len(result) > 0:
-        # Non empty output means found a listening server.
-        return True
-    else:
-        return False
-
-
-def _wait_for_server_start(port):
-    """Wait until server at given port is running / listening for connections."""
+    # Look the port up in the kernel's TCP socket table directly instead of
+    # forking netstat. Connecting to the port is not an option, since the
+    # server would accept that probe as its one and only client.
+    local_port = ":%04X" % port
+    tcp_listen_state = "0A"
+    with open("/proc/net/tcp") as tcp_table:
+        next(tcp_table)  # Skip the header line.
+        for line in tcp_table:
+            fields = line.split()
+            if fields[1].endswith(local_port) and fields[3] == tcp_listen_state:
+                return True
+    return False
+
+
+def _wait_for_server_start(port, timeout_secs=5):
+    """Wait until server at given port is running / listening for connections.
+
+    Returns whether the server started listening within timeout_secs.
+    """
+    debug_print_verbose("Waiting for server start at port %d" % port)
+    deadline = time.time() + timeout_secs
     while(not _is_server_listening(port)):
-        debug_print_verbose("Waiting for server start at port %d" % port)
-        time.sleep(2)
+        if time.time() > deadline:
+            return False
+        time.sleep(0.02)
     debug_print_verbose("Server started listening at port %d" % port)
+    return True
 
 
 def _run_experiment(loss, port, cong_ctrl, rtt, throughput, trace_up=None, trace_down=None):
-    """Run a single throughput experiment with the given loss rate."""
+    """Run a single throughput experiment with the given loss rate.
+
+    Returns whether the experiment ran successfully.
+    """
     debug_print("Running experiment [loss = " +
                 str(loss) + ", cong_ctrl = " + str(cong_ctrl) + ", rtt = " + str(rtt) + ", bw = " + str(throughput) + "]")
 
@@ -172,23 +272,17 @@ def _run_experiment(loss, port, cong_ctrl, rtt, throughput, trace_up=None, trace
 
     headless = Flags.parsed_args[Flags.HEADLESS]
 
-    # We are using an infinite buffer size.
-    if not headless:
-        if trace_up and trace_down:
-            command = ["stdbuf", "-o0", "mm-delay", str(rtt / 2), "mm-loss", "uplink", str(loss),
-                       "mm-link", str(trace_up), str(trace_down), "--uplink-log=/tmp/mahimahi_log", "--meter-uplink", "--once"]
-        else:
-            command = ["stdbuf", "-o0", "mm-delay", str(rtt / 2), "mm-loss", "uplink", str(loss),
-                       "mm-link", str(throughput) + "Mbps.up", str(throughput) +
-                       "Mbps.down", "--uplink-log=/tmp/mahimahi_log", "--meter-uplink", "--once"]
+    if trace_up and trace_down:
+        trace_args = [str(trace_up), str(trace_down)]
     else:
-        if trace_up and trace_down:
-            command = ["stdbuf", "-o0", "mm-delay", str(rtt / 2), "mm-loss", "uplink", str(loss),
-                       "mm-link", str(trace_up), str(trace_down), "--uplink-log=/tmp/mahimahi_log", "--once"]
-        else:
-            command = ["stdbuf", "-o0", "mm-delay", str(rtt / 2), "mm-loss", "uplink", str(loss),
-                       "mm-link", str(throughput) + "Mbps.up", str(throughput) +
-                       "Mbps.down", "--uplink-log=/tmp/mahimahi_log", "--once"]
+        trace_args = [str(throughput) + "Mbps.up", str(throughput) + "Mbps.down"]
+    log_args = ["--uplink-log=/tmp/mahimahi_log"]
+    if not headless:
+        log_args.append("--meter-uplink")
+
+    # We are using an infinite buffer size.
+    command = (["stdbuf", "-o0", "mm-delay", str(rtt // 2), "mm-loss", "uplink", str(loss), "mm-link"] +
+               trace_args + log_args + ["--once"])
 
     subcommand = ["--", "python", "-c",
                   "from client import run_client; run_client" + client_args]
@@ -198,17 +292,18 @@ def _run_experiment(loss, port, cong_ctrl, rtt, throughput, trace_up=None, trace
         subprocess.check_call(full_command, stderr=subprocess.STDOUT)
     except Exception as e:
         debug_print_error("Subprocess call error: " + str(e))
-        sys.exit(-1)
+        return False
+    return True
 
 
-def main():
-    """Run the experiments."""
-    # Grab the experimental parameterss
-    _parse_args()
+def _run_sweep(losses):
+    """Run an experiment for each of the given loss rates.
 
+    The server process and the client worker are started once and reused by
+    every experiment in the sweep.
+    """
     port = Flags.parsed_args[Flags.PORT]
     size = Flags.parsed_args[Flags.SIZE]
-    loss = Flags.parsed_args[Flags.LOSS]
     rtt = Flags.parsed_args[Flags.RTT]
     bw = Flags.parsed_args[Flags.BW]
     cc = Flags.parsed_args[Flags.CC]
@@ -219,74 +314,106 @@ def main():
     if uplink_trace is None and downlink_trace is None:
         _generate_trace(Flags.parsed_args[Flags.TIME], bw)
 
-    # Start the client and server
-    server_q = Queue()
+    # Start the server, which accepts one client connection per experiment.
+    server_results, server_conn = Pipe(duplex=False)
     e = Event()
-    server_proc = Server(server_q, e, cc, port, size)
+    server_proc = Server(server_conn, e, cc, port, size, len(losses))
+    client_pool = Pool(processes=1)
 
-    # Start client and wait for it to finish.
-    if uplink_trace is None and downlink_trace is None:
-        client_proc = Process(target=_run_experiment,
-                              args=(loss, port, cc, rtt, bw))
-    else:
-        client_proc = Process(target=_run_experiment,
-                              args=(loss, port, cc, rtt, bw, uplink_trace, downlink_trace))
+    # Open the output file once for the whole sweep, if it's set.
+    output = None
+    if output_file:
+        output = open(output_file, 'a')
+        # A new file gets the header line first.
+        output.seek(0, os.SEEK_END)
+        if output.tell() == 0:
+            header_line = "congestion_control, loss_rate, goodput_Mbps, rtt_ms, bandwidth_Mbps, specified_bw_Mbps"
+            output.write(header_line + "\n")
 
     server_proc.start()
-    # Wait a little to give server time to start up.
-    time.sleep(2)
-    _wait_for_server_start(port)
-    client_proc.start()
-    client_proc.join()
-    # Handle errors starting up the server.
-    if not server_proc.is_alive():
-        if server_proc.exitcode != EXIT_SUCCESS:
-            debug_print_error("Server Process Died unexpectedly. Terminating.")
+    if not _wait_for_server_start(port):
+        debug_print_error("Server did not start listening. Terminating.")
+        server_proc.terminate()
+        sys.exit(-1)
+    for loss in losses:
+        # Run the client and wait for it to finish.
+        client_ok = client_pool.apply(
+            _run_experiment, (loss, port, cc, rtt, bw, uplink_trace, downlink_trace))
+        # Handle errors starting up the server.
+        if not server_proc.is_alive():
+            if server_proc.exitcode != EXIT_SUCCESS:
+                debug_print_error("Server Process Died unexpectedly. Terminating.")
+                sys.exit(-1)
+        if not client_ok:
+            debug_print_error("Client failed to run. Terminating.")
+            server_proc.terminate()
             sys.exit(-1)
 
-    # Server is still alive, signal it to shutdown.
-    debug_print_verbose("Signal server to shutdown.")
-    e.set()
-
-    debug_print_verbose("Is Server Alive? %s" % (server_proc.is_alive()))
-    # Wait for server to shutdown, upto some timeout.
+        # Signal the server that the experiment is over, and wait for its
+        # result before it is reused for the next one.
+        debug_print_verbose("Signal server to end the experiment.")
+        e.set()
+        if not server_results.poll(10):
+            debug_print_error("Server did not report a result. Terminating.")
+            server_proc.terminate()
+            sys.exit(-1)
+        result, exception = server_results.recv()
+        if exception:
+            raise exception
+        debug_print_verbose(result)
+        e.clear()
+        debug_print_verbose("Run complete.")
+
+        (capacity, goodput, q_delay, s_delay) = _parse_mahimahi_log()
+        debug_print("Experiment complete!")
+
+        # Print the output
+        results = ', '.join([str(x)
+                             for x in [cc, loss, goodput, rtt, capacity, bw]])
+        stdout_print(results + "\n")
+
+        # Also write to output file if it's set. Flush it right away so that
+        # results survive a later experiment failing.
+        if output:
+            debug_print_verbose("Appending Result output to: %s" % output_file)
+            output.write(results + "\n")
+            output.flush()
+
+    if output:
+        output.close()
+    client_pool.close()
+    client_pool.join()
+
+    # The server shuts down after its last connection, wait for it upto some
+    # timeout.
     server_proc.join(10)
     # Check for errors from the server
-    debug_print_verbose("Run complete.")
-    while(not server_q.empty()):
-        result, exception = server_q.get()
+    while server_results.poll():
+        result, exception = server_results.recv()
         if exception:
             raise exception
         debug_print_verbose(result)
 
-    server_q.close()
+    server_results.close()
 
-    e.clear()
-    (capacity, goodput, q_delay, s_delay) = _parse_mahimahi_log(cc)
-    debug_print("Experiment complete!")
+    if uplink_trace is None and downlink_trace is None:
+        _clean_up_trace(bw)
 
-    # Print the output
-    results = ', '.join([str(x)
-                         for x in [cc, loss, goodput, rtt, capacity, bw]])
-    stdout_print(results + "\n")
 
-    # Also write to output file if it's set.
-    if output_file:
-        debug_print_verbose("Appending Result output to: %s" % output_file)
-        if os.path.exists(output_file):
-            with open(output_file, 'a') as output:
-                output.write(results + "\n")
-        else:
-            with open(output_file, 'a') as output:
-                header_line = "congestion_control, loss_rate, goodput_Mbps, rtt_ms, bandwidth_Mbps, specified_bw_Mbps"
-                output.write(header_line + "\n")
-                output.write(results + "\n")
+def main():
+    """Run the experiments."""
+    # Grab the experimental parameterss
+    _parse_args()
 
-    if uplink_trace is None and downlink_trace is None:
-        _clean_up_trace(bw)
+    _run_sweep(Flags.parsed_args[Flags.LOSS])
 
     debug_print("Terminating driver.")
 
 
 if __name__ == '__main__':
+    # Fork the server and client workers so they start from the parent's
+    # state, including the parsed flags, instead of re-importing everything.
+    # Python 2 always forks and has no set_start_method.
+    if hasattr(multiprocessing, 'set_start_method'):
+        multiprocessing.set_start_method('fork', force=True)
     main()
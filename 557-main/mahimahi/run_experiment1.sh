@@ -19,10 +19,8 @@ rm -f $LOG_FILE
 echo "Running  experiment 1: effect of bandwidth"
 
 for cc in $CONGESTION_CONTROL; do
-  for loss_rate in $LOSS_RATES; do
-    for bw in $BW_MBPS; do
-      echo "Executing trial with cc=$cc Loss rate: $loss_rate Bandwidth: $bw ..."
-      ./bbr_experiment.py --cc=$cc --loss=$loss_rate --bw=$bw --time 30 --output_file=$LOG_FILE $@
-    done
+  for bw in $BW_MBPS; do
+    echo "Executing trials with cc=$cc Loss rates: $LOSS_RATES Bandwidth: $bw ..."
+    ./bbr_experiment.py --cc=$cc --loss $LOSS_RATES --bw=$bw --time 30 --output_file=$LOG_FILE $@
   done
 done
@@ -17,8 +17,6 @@ rm -f $LOG_FILE
 # Run experiment.
 echo "Running experiment 2: Effect of different Congestion Control Algorithms."
 for cc in $CONGESTION_CONTROL; do
-  for loss_rate in $LOSS_RATES; do
-    echo "Executing trial with cc=$cc Loss rate: $loss_rate ..."
-    ./bbr_experiment.py --cc=$cc --loss=$loss_rate --time 30 --output_file=$LOG_FILE $@
-  done
+  echo "Executing trials with cc=$cc Loss rates: $LOSS_RATES ..."
+  ./bbr_experiment.py --cc=$cc --loss $LOSS_RATES --time 30 --output_file=$LOG_FILE $@
 done
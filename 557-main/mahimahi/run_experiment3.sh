@@ -20,10 +20,8 @@ rm -f $LOG_FILE
 echo "Running experiment 3: effect of RTT"
 
 for cc in $CONGESTION_CONTROL; do
-  for loss_rate in $LOSS_RATES; do
-    for rtt in $RTTS_MS; do
-      echo "Executing trial with cc=$cc Loss rate: $loss_rate RTT (ms): $rtt ..."
-      ./bbr_experiment.py --cc=$cc --loss=$loss_rate --time 120 --rtt=$rtt --output_file=$LOG_FILE $@
-    done
+  for rtt in $RTTS_MS; do
+    echo "Executing trials with cc=$cc Loss rates: $LOSS_RATES RTT (ms): $rtt ..."
+    ./bbr_experiment.py --cc=$cc --loss $LOSS_RATES --time 120 --rtt=$rtt --output_file=$LOG_FILE $@
   done
 done
@@ -12,14 +12,19 @@ import time
 class Server(Process):
     """Server class that simply receives data."""
 
-    def __init__(self, outputQueue, event, cc, port=5050, size=1024):
-        """Initialize server with input and output Queues."""
+    def __init__(self, outputConn, event, cc, port=5050, size=1024, num_connections=1):
+        """Initialize server with its shutdown event and output Pipe connection.
+
+        The server handles num_connections client connections one after the
+        other, each until the event is set, and then shuts down.
+        """
         super(Server, self).__init__()
-        self.outQ = outputQueue
+        self.outConn = outputConn
         self.e = event
         self.cc = cc
         self.port = port
         self.size = size
+        self.num_connections = num_connections
 
     def _handle_connection(self, conn):
         num_msg = 0
@@ -48,7 +53,7 @@ class Server(Process):
         goodput = (num_msg * self.size * 8) / elapsed_time / 1e6
 
         # Send the Goodput back to the master
-        self.outQ.put(("Estimated goodput: " + str(goodput), None))
+        self.outConn.send(("Estimated goodput: " + str(goodput), None))
 
     def run(self):
         """Run the server continuously."""
@@ -60,15 +65,16 @@ class Server(Process):
             s.bind(('', self.port))
         except Exception as e:
             debug_print_error("Binding Error: " + str(e))
-            self.outQ.put((None, e))
+            self.outConn.send((None, e))
             sys.exit(-1)
 
-        s.listen(1)  # only have 1 connection
-        debug_print("Server awaiting connection on port %d" % self.port)
-
-        conn, _ = s.accept()
-        debug_print("Server Accepted connection")
-        self._handle_connection(conn)
+        s.listen(1)  # only have 1 connection at a time
+        for _ in range(self.num_connections):
+            debug_print("Server awaiting connection on port %d" % self.port)
+            conn, _ = s.accept()
+            debug_print("Server Accepted connection")
+            self._handle_connection(conn)
+            conn.close()
         s.shutdown(socket.SHUT_RDWR)
         s.close()
         debug_print("Shutdown server")